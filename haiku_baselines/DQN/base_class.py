@@ -71,7 +71,8 @@ class Q_Network_Family(object):
         save(path, self.params)
             
     def load_params(self, path):
-        self.params = self.target_params = restore(path)
+        self.params = restore(path)
+        self.target_params = jax.tree_map(jnp.copy, self.params) # separate buffers, both are donated in _train_step
         
     def get_env_setup(self):
         print("----------------------env------------------------")
@@ -140,6 +141,20 @@ class Q_Network_Family(object):
             else:
                 self.replay_buffer = ReplayBuffer(self.buffer_size,self.observation_space, 1)
     
+    def get_dummy_batch(self, gradient_steps = None):
+        # zero batch matching the replay buffer's sample() shapes and dtypes, stacked over gradient_steps if given
+        lead = (self.batch_size,) if gradient_steps is None else (gradient_steps, self.batch_size)
+        data = {
+            'obses'     : [np.zeros((*lead,*v['shape']),dtype=v['dtype']) for v in self.replay_buffer.obsdict.values()],
+            'actions'   : np.zeros((*lead,1),dtype=np.float32),
+            'rewards'   : np.zeros((*lead,1),dtype=np.float32),
+            'nxtobses'  : [np.zeros((*lead,*v['shape']),dtype=v['dtype']) for v in self.replay_buffer.nextobsdict.values()],
+            'dones'     : np.zeros((*lead,1),dtype=np.float32)
+            }
+        if self.prioritized_replay:
+            data['weights'] = np.ones(lead,dtype=np.float32)
+        return data
+    
     def setup_model(self):
         pass
     
@@ -149,6 +164,11 @@ class Q_Network_Family(object):
     def _get_actions(self, params, obses) -> np.ndarray:
         pass
     
+    # _get_actions vmapped over a leading env axis: obses [env x worker x ...], keys one per env (or None)
+    # -> actions [env x worker x 1]. Callers stacking several envs should use this rather than loop over _get_actions.
+    def _get_actions_batched(self, params, obses, keys) -> np.ndarray:
+        pass
+    
     def actions(self,obs,epsilon):
         if epsilon <= np.random.uniform(0,1):
             actions = np.asarray(self._get_actions(self.params,obs,next(self.key_seq) if self.param_noise else None))
@@ -4,14 +4,55 @@ import haiku as hk
 import numpy as np
 import optax
 from einops import rearrange, reduce, repeat
+from functools import partial
 
 from haiku_baselines.DQN.base_class import Q_Network_Family
 from haiku_baselines.QRDQN.network import Model
 from haiku_baselines.common.Module import PreProcess
 
-from haiku_baselines.common.utils import hard_update, convert_jax, print_param, q_log_pi
+from haiku_baselines.common.utils import convert_jax, print_param, q_log_pi
 from haiku_baselines.common.losses import QuantileHuberLosses
 
+def _loss(params, obses, actions, targets, weights, key, get_q, quantile, delta):
+    theta_loss_tile = jnp.take_along_axis(get_q(params, obses, key), actions, axis=1)  # batch x 1 x support
+    logit_valid_tile = jnp.expand_dims(targets,axis=2)                                      # batch x support x 1
+    loss = QuantileHuberLosses(theta_loss_tile, logit_valid_tile, quantile, delta)
+    # importance weights renormalised by their batch max, so they are 1 for uniform replay
+    weights = weights * (1.0 / jnp.max(weights))
+    return jnp.mean(loss * weights), loss
+
+def _target(params, target_params, obses, actions, rewards, nxtobses, not_dones, key,
+            get_q, gamma, double_q, munchausen, munchausen_alpha, munchausen_entropy_tau):
+    if munchausen:
+        # one target network pass over [obses; nxtobses] instead of two
+        q_k_targets, next_q = jnp.split(
+            get_q(target_params,[jnp.concatenate([o,n],axis=0) for o,n in zip(obses,nxtobses)],key),2,axis=0)
+        if double_q:
+            next_q_mean = jnp.mean(get_q(params,nxtobses,key),axis=2)
+        else:
+            next_q_mean = jnp.mean(next_q,axis=2)
+        next_sub_q, tau_log_pi_next = q_log_pi(next_q_mean, munchausen_entropy_tau)
+        # sample an action from the softmax policy for every support, batch x 1 x support
+        ind = jnp.expand_dims(jax.random.categorical(key, jnp.expand_dims(next_sub_q/munchausen_entropy_tau,axis=1), axis=2,
+                                                     shape=(next_q.shape[0],next_q.shape[2])),axis=1)
+        sampled_q = jnp.squeeze(jnp.take_along_axis(next_q - jnp.expand_dims(tau_log_pi_next,axis=2),ind,axis=1),axis=1)
+        next_vals = sampled_q * not_dones
+
+        q_k_targets = jnp.mean(q_k_targets,axis=2)
+        q_sub_targets, tau_log_pi = q_log_pi(q_k_targets, munchausen_entropy_tau)
+        log_pi = q_sub_targets - munchausen_entropy_tau*tau_log_pi
+        munchausen_addon = jnp.take_along_axis(log_pi,jnp.squeeze(actions,axis=2),axis=1)
+
+        rewards = rewards + munchausen_alpha*jnp.clip(munchausen_addon, a_min=-1, a_max=0)
+    else:
+        next_q = get_q(target_params,nxtobses,key)
+        if double_q:
+            next_actions = jnp.expand_dims(jnp.argmax(jnp.mean(get_q(params,nxtobses,key),axis=2),axis=1),axis=(1,2))
+        else:
+            next_actions = jnp.expand_dims(jnp.argmax(jnp.mean(next_q,axis=2),axis=1),axis=(1,2))
+        next_vals = not_dones * jnp.squeeze(jnp.take_along_axis(next_q, next_actions, axis=1)) # batch x support
+    return (next_vals * gamma) + rewards                                                 # batch x support
+
 class QRDQN(Q_Network_Family):
     def __init__(self, env, gamma=0.995, learning_rate=3e-4, buffer_size=100000, exploration_fraction=0.3, n_support = 200, delta = 0.1,
                  exploration_final_eps=0.02, exploration_initial_eps=1.0, train_freq=1, gradient_steps=1, batch_size=32, double_q=True,
@@ -38,41 +79,59 @@ class QRDQN(Q_Network_Family):
         if 'cnn_mode' in self.policy_kwargs.keys():
             cnn_mode = self.policy_kwargs['cnn_mode']
             del self.policy_kwargs['cnn_mode']
-        self.preproc = hk.transform(lambda x: PreProcess(self.observation_space, cnn_mode=cnn_mode)(x))
-        self.model = hk.transform(lambda x: Model(self.action_size,
+        self.net = hk.transform(lambda x: Model(self.action_size,
                            dueling=self.dueling_model,noisy=self.param_noise,support_n=self.n_support,
-                           **self.policy_kwargs)(x))
-        pre_param = self.preproc.init(next(self.key_seq),
+                           **self.policy_kwargs)(PreProcess(self.observation_space, cnn_mode=cnn_mode)(x)))
+        self.params = self.net.init(next(self.key_seq),
                             [np.zeros((1,*o),dtype=np.float32) for o in self.observation_space])
-        model_param = self.model.init(next(self.key_seq),
-                            self.preproc.apply(pre_param, 
-                            None, [np.zeros((1,*o),dtype=np.float32) for o in self.observation_space]))
-        self.params = hk.data_structures.merge(pre_param, model_param)
-        self.target_params = self.params
+        self.target_params = jax.tree_map(jnp.copy, self.params) # separate buffers, both are donated in _train_step
         
         self.opt_state = self.optimizer.init(self.params)
+        self._master_key = next(self.key_seq)
         
-        if not self.dueling_model:
-            self.quantile = (jnp.linspace(0.0,1.0,self.n_support+1)[1:] + jnp.linspace(0.0,1.0,self.n_support+1)[:-1])/2.0   # [support]
-            self.quantile = jax.device_put(jnp.expand_dims(self.quantile,axis=(0,1)))                                        # [1 x 1 x support]
-        else:
-            self.quantile = (jnp.linspace(0.0,1.0,self.n_support*self.n_support+1)[1:] + jnp.linspace(0.0,1.0,self.n_support*self.n_support+1)[:-1])/2.0   # [support]
-            self.quantile = jax.device_put(jnp.expand_dims(self.quantile,axis=(0,1)))                                        # [1 x 1 x support]
+        quantile_n = self.n_support if not self.dueling_model else self.n_support*self.n_support
+        quantile = np.linspace(0.0,1.0,quantile_n+1,dtype=np.float32)
+        self.quantile = jnp.asarray(((quantile[1:] + quantile[:-1])/2.0)[None,None,:])                              # [1 x 1 x support]
         
         print("----------------------model----------------------")
-        print_param('preprocess',pre_param)
-        print_param('model',model_param)
+        print_param('model',self.params)
         print("loss : quaile_huber_loss")
         print("-------------------------------------------------")
 
         self.get_q = jax.jit(self.get_q)
         self._get_actions = jax.jit(self._get_actions)
-        self._loss = jax.jit(self._loss)
-        self._target = jax.jit(self._target)
-        self._train_step = jax.jit(self._train_step)
+        self._get_actions_batched = jax.jit(jax.vmap(self._get_actions, in_axes=(None,0,0)))
+        # hyperparameters are bound as Python constants so the unused branches are traced away
+        self._loss = jax.jit(partial(_loss, get_q=self.get_q, quantile=self.quantile, delta=self.delta))
+        self._target = jax.jit(partial(_target, get_q=self.get_q, gamma=self._gamma, double_q=self.double_q,
+                                       munchausen=self.munchausen, munchausen_alpha=self.munchausen_alpha,
+                                       munchausen_entropy_tau=self.munchausen_entropy_tau))
+        # params, target_params and opt_state are rebound from the outputs, so their buffers can be reused
+        self._train_step = jax.jit(self._train_step, donate_argnums=(0,1,2), static_argnames=('update_target',))
+        self._train_steps = jax.jit(self._train_steps, donate_argnums=(0,1,2), static_argnames=('update_target',))
+        self._train_step_compiled = {} # ahead-of-time executables keyed by update_target, see compile_train_step
+    
+    def compile_train_step(self):
+        # compile the update for the replay batch shape before training instead of stalling the first step.
+        # one executable per update_target: one copies params into the target network, the other leaves it alone.
+        # other shapes fall back to the lazily jitted functions
+        if self._train_step_compiled:
+            return
+        if self.prioritized_replay:
+            self._train_step_compiled = {
+                update_target: self._train_step.lower(self.params, self.target_params, self.opt_state, 0, 0,
+                                                      update_target=update_target, **self.get_dummy_batch()).compile()
+                for update_target in [False, True]
+                }
+        else:
+            self._train_step_compiled = {
+                update_target: self._train_steps.lower(self.params, self.target_params, self.opt_state, 0,
+                                                       self.get_dummy_batch(self.gradient_steps), update_target=update_target).compile()
+                for update_target in [False, True]
+                }
     
     def get_q(self, params, obses, key = None) -> jnp.ndarray:
-        return self.model.apply(params, key, self.preproc.apply(params, key, obses))
+        return self.net.apply(params, key, obses)
         
     def _get_actions(self, params, obses, key = None) -> jnp.ndarray:
         return jnp.expand_dims(jnp.argmax(
@@ -80,18 +139,30 @@ class QRDQN(Q_Network_Family):
                ,axis=1),axis=1)
     
     def train_step(self, steps, gradient_steps):
-        for _ in range(gradient_steps):
-            if self.prioritized_replay:
+        update_target = steps % self.target_network_update_freq == 0
+        if self.prioritized_replay:
+            for gradient_step in range(gradient_steps):
                 data = self.replay_buffer.sample(self.batch_size,self.prioritized_replay_beta0)
-            else:
-                data = self.replay_buffer.sample(self.batch_size)
-            
-            self.params, self.target_params, self.opt_state, loss, t_mean, new_priorities = \
-                self._train_step(self.params, self.target_params, self.opt_state, steps, 
-                                 next(self.key_seq) if self.param_noise or self.munchausen else None,**data)
+                indexes = data.pop('indexes') # only needed on host for the priority update
+                
+                if self._train_step_compiled:
+                    _train_step = self._train_step_compiled[update_target]
+                else:
+                    _train_step = partial(self._train_step, update_target=update_target)
+                self.params, self.target_params, self.opt_state, loss, t_mean, new_priorities = \
+                    _train_step(self.params, self.target_params, self.opt_state, steps, gradient_step, **data)
+                
+                self.replay_buffer.update_priorities(indexes, new_priorities)
+        else:
+            # without priorities the batches don't depend on earlier updates, so run every gradient step in one scan
+            data = jax.tree_map(lambda *x: np.stack(x), *[self.replay_buffer.sample(self.batch_size) for _ in range(gradient_steps)])
             
-            if self.prioritized_replay:
-                self.replay_buffer.update_priorities(data['indexes'], new_priorities)
+            if gradient_steps == self.gradient_steps and self._train_step_compiled:
+                _train_steps = self._train_step_compiled[update_target]
+            else:
+                _train_steps = partial(self._train_steps, update_target=update_target)
+            self.params, self.target_params, self.opt_state, loss, t_mean = \
+                _train_steps(self.params, self.target_params, self.opt_state, steps, data)
             
         if self.summary and steps % self.log_interval == 0:
             self.summary.add_scalar("loss/qloss", loss, steps)
@@ -99,61 +170,35 @@ class QRDQN(Q_Network_Family):
             
         return loss
 
-    def _train_step(self, params, target_params, opt_state, steps, key, 
-                    obses, actions, rewards, nxtobses, dones, weights=1, indexes=None):
+    def _train_steps(self, params, target_params, opt_state, steps, data, update_target=False):
+        def step(carry, inputs):
+            params, target_params, opt_state = carry
+            gradient_step, batch = inputs
+            params, target_params, opt_state, loss, t_mean, _ = \
+                self._train_step(params, target_params, opt_state, steps, gradient_step, update_target=update_target, **batch)
+            return (params, target_params, opt_state), (loss, t_mean)
+        (params, target_params, opt_state), (loss, t_mean) = \
+            jax.lax.scan(step, (params, target_params, opt_state), (jnp.arange(data['dones'].shape[0]), data))
+        return params, target_params, opt_state, loss[-1], t_mean[-1]
+
+    def _train_step(self, params, target_params, opt_state, steps, gradient_step, 
+                    obses, actions, rewards, nxtobses, dones, weights=1, update_target=False):
+        # derive the key from the step counters on device instead of drawing one from key_seq per update
+        key = jax.random.fold_in(jax.random.fold_in(self._master_key, steps), gradient_step) if self.param_noise or self.munchausen else None
         obses = convert_jax(obses); nxtobses = convert_jax(nxtobses); actions = jnp.expand_dims(actions.astype(jnp.int32),axis=2); not_dones = 1.0 - dones
         targets = self._target(params, target_params, obses, actions, rewards, nxtobses, not_dones, key)
         (loss,abs_error), grad = jax.value_and_grad(self._loss,has_aux = True)(params, obses, actions, targets, weights, key)
         updates, opt_state = self.optimizer.update(grad, opt_state, params=params)
         params = optax.apply_updates(params, updates)
-        target_params = hard_update(params, target_params, steps, self.target_network_update_freq)
+        if update_target:
+            target_params = params
         new_priorities = None
         if self.prioritized_replay:
             new_priorities = abs_error + self.prioritized_replay_eps
         return params, target_params, opt_state, loss, jnp.mean(targets), new_priorities
     
-    def _loss(self, params, obses, actions, targets, weights, key):
-        theta_loss_tile = jnp.take_along_axis(self.get_q(params, obses, key), actions, axis=1)  # batch x 1 x support
-        logit_valid_tile = jnp.expand_dims(targets,axis=2)                                      # batch x support x 1
-        loss = QuantileHuberLosses(theta_loss_tile, logit_valid_tile, self.quantile, self.delta)
-        return jnp.mean(loss * weights / jnp.max(weights)), loss #remove weight multiply cpprb weight is something wrong
-    
-    def _target(self,params, target_params, obses, actions, rewards, nxtobses, not_dones, key):
-        next_q = self.get_q(target_params,nxtobses,key)
-            
-        if self.munchausen:
-            if self.double_q:
-                next_q_mean = jnp.mean(self.get_q(params,nxtobses,key),axis=2)
-            else:
-                next_q_mean = jnp.mean(next_q,axis=2)
-            next_sub_q, tau_log_pi_next = q_log_pi(next_q_mean, self.munchausen_entropy_tau)
-            pi_next = jax.nn.softmax(next_sub_q/self.munchausen_entropy_tau,axis=1)
-            p_cuml = jnp.expand_dims(jnp.cumsum(pi_next,axis=1),axis=2).tile(32)
-            r = jax.random.uniform(key, (32,1,32), dtype=p_cuml.dtype)
-            ind = jnp.swapaxes(jax.vmap(jax.vmap(lambda p,r: jnp.searchsorted(p, r),in_axes=(1,1)))(p_cuml,r),1,2)
-            sampled_q = jnp.take_along_axis(next_q - jnp.expand_dims(tau_log_pi_next,axis=2),ind,axis=1).squeeze()
-            next_vals = sampled_q * not_dones
-            
-            if self.double_q:
-                q_k_targets = jnp.mean(self.get_q(params,obses,key),axis=2)
-            else:
-                q_k_targets = jnp.mean(self.get_q(target_params,obses,key),axis=2)
-            q_k_targets = jnp.mean(self.get_q(target_params,obses,key),axis=2)
-            q_sub_targets, tau_log_pi = q_log_pi(q_k_targets, self.munchausen_entropy_tau)
-            log_pi = q_sub_targets - self.munchausen_entropy_tau*tau_log_pi
-            munchausen_addon = jnp.take_along_axis(log_pi,jnp.squeeze(actions,axis=2),axis=1)
-            
-            rewards = rewards + self.munchausen_alpha*jnp.clip(munchausen_addon, a_min=-1, a_max=0)
-        else:
-            if self.double_q:
-                next_actions = jnp.expand_dims(jnp.argmax(jnp.mean(self.get_q(params,nxtobses,key),axis=2),axis=1),axis=(1,2))
-            else:
-                next_actions = jnp.expand_dims(jnp.argmax(jnp.mean(next_q,axis=2),axis=1),axis=(1,2))
-            next_vals = not_dones * jnp.squeeze(jnp.take_along_axis(next_q, next_actions, axis=1)) # batch x support
-        return (next_vals * self._gamma) + rewards                                                 # batch x support
-
-    
     def learn(self, total_timesteps, callback=None, log_interval=100, tb_log_name="QRDQN",
               reset_num_timesteps=True, replay_wrapper=None):
+        self.compile_train_step()
         tb_log_name = tb_log_name + "({:d})".format(self.n_support)
         super().learn(total_timesteps, callback, log_interval, tb_log_name, reset_num_timesteps, replay_wrapper)
\ No newline at end of file
@@ -6,8 +6,6 @@ def unique(sorted_array: np.ndarray) -> np.ndarray:
     :param sorted_array: (np.ndarray)
     :return:(np.ndarray) sorted_array without duplicate elements
     """
-    if len(sorted_array) == 1:
-        return sorted_array
     left = sorted_array[:-1]
     right = sorted_array[1:]
     uniques = np.append(right != left, True)
@@ -37,25 +35,25 @@ class SegmentTree(object):
         """
         assert capacity > 0 and capacity & (capacity - 1) == 0, "capacity must be positive and a power of 2."
         self._capacity = capacity
-        self._value = np.full(2*capacity,neutral_element) #[neutral_element for _ in range(2 * capacity)]
+        self._value = np.full(2*capacity,neutral_element,dtype=np.float64) #[neutral_element for _ in range(2 * capacity)]
         self._operation = operation
         self.neutral_element = neutral_element
 
-    def _reduce_helper(self, _value, start, end, node, node_start, node_end):
-        if start == node_start and end == node_end:
-            return _value[node]
-        
-        mid = (node_start + node_end) // 2
-        if end <= mid:
-            return self._reduce_helper(_value, start, end, 2 * node, node_start, mid)
-        else:
-            if mid + 1 <= start:
-                return self._reduce_helper(_value, start, end, 2 * node + 1, mid + 1, node_end)
-            else:
-                return self._operation(
-                    self._reduce_helper(_value, start, mid, 2 * node, node_start, mid),
-                    self._reduce_helper(_value, mid + 1, end, 2 * node + 1, mid + 1, node_end)
-                )
+    def _reduce_helper(self, _value, start, end):
+        # iterative bottom-up walk over the leaves of [start, end]
+        left = start + self._capacity
+        right = end + self._capacity + 1
+        result = self.neutral_element
+        while left < right:
+            if left & 1:
+                result = self._operation(result, _value[left])
+                left += 1
+            if right & 1:
+                right -= 1
+                result = self._operation(result, _value[right])
+            left >>= 1
+            right >>= 1
+        return result
 
     def reduce(self, start=0, end=None):
         """
@@ -73,7 +71,7 @@ class SegmentTree(object):
         if end < 0:
             end += self._capacity
         end -= 1
-        return self._reduce_helper(self._value, start, end, 1, 0, self._capacity - 1)
+        return self._reduce_helper(self._value, start, end)
 
     def _setitem_helper(self, _value, idxs):
         idxs = unique(idxs // 2)
@@ -89,11 +87,9 @@ class SegmentTree(object):
         
     def __setitem__(self, idx, val):
         # indexes of the leaf
-        idxs = idx + self._capacity
+        idxs = np.atleast_1d(idx) + self._capacity
         
         self._value[idxs] = val
-        if isinstance(idxs, int):
-            idxs = np.array([idxs])
         # go up one level in the tree and remove duplicate indexes
         self._value = self._setitem_helper(self._value, idxs)
 
@@ -110,6 +106,7 @@ class SumSegmentTree(SegmentTree):
             operation=np.add,
             neutral_element=0.0
         )
+        self._depth = capacity.bit_length() - 1
         
 
     def sum(self, start=0, end=None):
@@ -123,19 +120,14 @@ class SumSegmentTree(SegmentTree):
         return super(SumSegmentTree, self).reduce(start, end)
 
     def _find_prefixsum_idx_helper(self, _value ,prefixsum):
-        idx = np.ones(len(prefixsum), dtype=int)
-        cont = np.ones(len(prefixsum), dtype=bool)
-
-        while np.any(cont):  # while not all nodes are leafs
-            idx[cont] = 2 * idx[cont]
-            prefixsum_new = np.where(_value[idx] <= prefixsum, prefixsum - _value[idx], prefixsum)
-            # prepare update of prefixsum for all right children
-            idx = np.where(np.logical_or(_value[idx] > prefixsum, np.logical_not(cont)), idx, idx + 1)
-            # Select child node for non-leaf nodes
-            prefixsum = prefixsum_new
-            # update prefixsum
-            cont = idx < self._capacity
-            # collect leafs
+        idx = np.ones(len(prefixsum), dtype=np.int64)
+        for _ in range(self._depth):  # every query reaches a leaf after exactly depth levels
+            idx = 2 * idx
+            left = _value[idx]
+            go_right = left <= prefixsum
+            # subtract the left subtree mass for queries which descend right
+            prefixsum = np.where(go_right, prefixsum - left, prefixsum)
+            idx = np.where(go_right, idx + 1, idx)
         return idx - self._capacity
     
     def find_prefixsum_idx(self, prefixsum):
@@ -153,7 +145,7 @@ class SumSegmentTree(SegmentTree):
         if isinstance(prefixsum, float):
             prefixsum = np.array([prefixsum])
         assert 0 <= np.min(prefixsum)
-        assert np.max(prefixsum) <= self.sum() + 1e-5
+        assert np.max(prefixsum) <= self._value[1] + 1e-5  # root node holds the total sum
         assert isinstance(prefixsum[0], float)
         return self._find_prefixsum_idx_helper(self._value,prefixsum)
 
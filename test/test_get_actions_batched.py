@@ -0,0 +1,27 @@
+import gym
+import numpy as np
+import jax
+
+from haiku_baselines.DQN.dqn import DQN
+from haiku_baselines.QRDQN.qrdqn import QRDQN
+
+class ImageEnv(gym.Env):
+	observation_space = gym.spaces.Box(0, 255, (84, 84, 4), dtype=np.uint8)
+	action_space = gym.spaces.Discrete(4)
+
+n_env = 3
+# _get_actions_batched must match looping _get_actions over the env axis, for vector and image (4D per env) obs,
+# with keys=None and with one noise key per env
+for env in [gym.make("CartPole-v1"), ImageEnv()]:
+	for algo in [DQN, QRDQN]:
+		for param_noise in [False, True]:
+			agent = algo(env, param_noise=param_noise, buffer_size=64, batch_size=8, policy_kwargs={'cnn_mode': 'normal'})
+			obses = [np.random.randint(0, 256, [n_env, agent.worker_size] + o).astype(np.uint8 if len(o) >= 3 else np.float32)
+					 for o in agent.observation_space]
+			keys = jax.random.split(next(agent.key_seq), n_env) if param_noise else None
+			batched = np.asarray(agent._get_actions_batched(agent.params, obses, keys))
+			looped = np.stack([np.asarray(agent._get_actions(agent.params, [o[e] for o in obses], keys[e] if param_noise else None))
+							   for e in range(n_env)])
+			print(algo.__name__, env.observation_space.shape, param_noise, batched.shape, looped.shape)
+			assert batched.shape == (n_env, agent.worker_size, 1)
+			assert np.array_equal(batched, looped)